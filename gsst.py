@@ -28,10 +28,9 @@ USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import simtk.unit as unit
 from simtk.openmm import CustomIntegrator
-import math
-import random
+from math import log as _log
+from random import random as _rand
 from sys import stdout
-from scipy.special import logsumexp
 import numpy as np
 
 try:
@@ -44,6 +43,46 @@ try:
     have_gzip = True
 except: have_gzip = False
 
+try:
+    from numba import njit
+    have_numba = True
+except: have_numba = False
+
+def _lse(x):
+    #log-sum-exp of a small 1D array. scipy's logsumexp is dominated by
+    #argument handling at the sizes used here (one entry per level).
+    m = x.max()
+    if not np.isfinite(m):
+        return m
+    return m + _log(np.exp(x - m).sum())
+
+def _mc_step_py(weights, energies, beta, r):
+    #this turns the PE into a 'reduced potential', then calculates the normalized probability that the
+    #present configuration would have come from each of the levels. It then uses metropolized
+    #independence sampling to pick a level, using the uniform random number `r`. 
+    #Returns the proposed level and the probability of each level.
+    logProbability = weights - beta*energies
+    logProbability -= _lse(logProbability)
+    probability = np.exp(logProbability)
+
+    #peter eastmans no-numpy way:
+    #maxLogProb = max(logProbability)
+    #offset = maxLogProb + math.log(sum(math.exp(x-maxLogProb) for x in logProbability))
+    #probability = [math.exp(x-offset) for x in logProbability]
+
+    #searchsorted on the cumulative probability picks the first level whose cdf exceeds r. 
+    #clamp in case rounding leaves the cdf total slightly below r.
+    j = int(np.searchsorted(np.cumsum(probability), r, side='right'))
+    return min(j, len(probability)-1), probability
+
+if have_numba:
+    #compile the same code. fastmath is left off because it lets the compiler assume
+    #finite values and drop the non-finite guard in _lse.
+    _lse = njit(cache=True)(_lse)
+    _mc_step = njit(cache=True)(_mc_step_py)
+else:
+    _mc_step = _mc_step_py
+
 class GSST(object):
     """This script implements generalized serial simulated tempering.
     
@@ -80,11 +119,14 @@ class GSST(object):
       such that adjacently sampled potential energies are uncorrelated, i.e. 
       this should be longer than the autocorrelation time of the PE for the 
       process being tempered. 
+      - the report file is written in buffered blocks. Call `flush()` before reading it
+      while the simulation is still running, and `close()` once you are done with GSST.
       
     """
 
     def __init__(self, simulation, scaling_function, levels, cutoff, baseTemp,
-                    weights=None, changeInterval=1000, reportInterval=1000, reportFile=stdout,):
+                    weights=None, changeInterval=1000, reportInterval=1000, reportFile=stdout,
+                    forceGroup=None, parameterName=None, linearScaling=False):
         """Create a new SimulatedTempering.
 
         Parameters
@@ -108,47 +150,89 @@ class GSST(object):
             The interval (in time steps) at which to write information to the report file
         reportFile: string or file
             The file to write reporting information to, specified as a file name or file object
+        forceGroup: int
+            The force group containing the tempered custom force, and nothing else. If given,
+            the rest of the potential energy is calculated once per report, and only this group
+            is re-evaluated at each level. If None, the full potential energy is re-evaluated at each level.
+        parameterName: string
+            The name of the context parameter that `scaling_function` sets. If given, the reporter
+            sets this parameter directly when scanning the levels, instead of calling `scaling_function`.
+            Leave as None if `scaling_function` does anything more than set one parameter.
+        linearScaling: bool
+            If True, the potential energy is assumed to be linear in the tempered parameter, i.e.
+            U(level) = U(current) + (level - current)*dU/dlevel, so one energy evaluation (with the
+            parameter derivative) gives the energy at every level. Requires `parameterName`, and the
+            tempered force must declare it with `addEnergyParameterDerivative(parameterName)`.
+            Only use this when the scaling is exactly linear (e.g. lambda*U_custom), otherwise the
+            energies, and therefore the weights, will be wrong.
         """
         self.cutoff = cutoff
         self.scaling_function=scaling_function
         self.levels = levels
         self.baseTemp = baseTemp
         self.inverseBaseTemperature = 1.0/(unit.MOLAR_GAS_CONSTANT_R*self.baseTemp)
+        #1/RT as a plain float (mol/kJ), since the MC step works on unit-stripped energies in kJ/mol:
+        self._beta = self.inverseBaseTemperature.value_in_unit(unit.mole/unit.kilojoule)
         self.simulation = simulation
         self.changeInterval = changeInterval
         self.reportInterval = reportInterval
         self.levels = levels
+        self.forceGroup = forceGroup
+        if forceGroup is not None:
+            #getState takes an unsigned 32 bit bitmask of force groups:
+            self._forceGroupMask = 1<<forceGroup
+            self._staticGroupMask = 0xffffffff ^ self._forceGroupMask
+        self._parameterName = parameterName
+        if parameterName is not None:
+            self._ctx = simulation.context
 
         # If necessary, open the file we will write reports to.
 
         self._openedFile = isinstance(reportFile, str)
         if self._openedFile:
             # Detect the desired compression scheme from the filename extension
-            # and open all files unbuffered
+            # and open all files in binary mode and buffered, so reports
+            # reach the disk in blocks rather than one line at a time
             if reportFile.endswith('.gz'):
                 if not have_gzip:
                     raise RuntimeError("Cannot write .gz file because Python could not import gzip library")
-                self._out = gzip.GzipFile(fileobj=open(reportFile, 'wb', 0))
+                self._out = gzip.GzipFile(reportFile, 'wb')
             elif reportFile.endswith('.bz2'):
                 if not have_bz2:
                     raise RuntimeError("Cannot write .bz2 file because Python could not import bz2 library")
-                self._out = bz2.BZ2File(reportFile, 'w', 0)
+                self._out = bz2.BZ2File(reportFile, 'w')
             else:
-                self._out = open(reportFile, 'w', 1)
+                self._out = open(reportFile, 'wb', 65536)
         else:
             self._out = reportFile
 
         # Initialize the weights.
 
         if weights is None:
-            self._weights = [0.0]*len(self.levels)
+            self._weights = np.zeros(len(self.levels), dtype=np.float64)
             self._updateWeights = True
             self._weightUpdateFactor = 1.0
-            self._histogram = [0]*len(self.levels)
+            self._histogram = np.zeros(len(self.levels), dtype=np.int64)
+            self._histogramSum = 0
             self._hasMadeTransition = False
         else:
-            self._weights = weights
+            self._weights = np.array(weights, dtype=np.float64)
             self._updateWeights = False
+            self._weightUpdateFactor = 0.0
+
+        # If requested, check the tempered force can give every level from one evaluation.
+
+        self._linearScaling = linearScaling
+        if linearScaling:
+            if parameterName is None:
+                raise ValueError("linearScaling requires parameterName")
+            derivatives = set()
+            for force in simulation.system.getForces():
+                if hasattr(force, 'getNumEnergyParameterDerivatives'):
+                    derivatives.update(force.getEnergyParameterDerivativeName(i) for i in range(force.getNumEnergyParameterDerivatives()))
+            if parameterName not in derivatives:
+                raise ValueError("linearScaling requires a force with addEnergyParameterDerivative('%s')" % parameterName)
+            self._levelsArray = np.asarray(self.levels, dtype=np.float64)
 
         # Select the starting level of tempering.
 
@@ -164,28 +248,56 @@ class GSST(object):
 
             def describeNextReport(self, simulation):
                 st = self.st
-                steps1 = st.changeInterval - simulation.currentStep%st.changeInterval
-                steps2 = st.reportInterval - simulation.currentStep%st.reportInterval
+                step = simulation.currentStep
+                steps1 = st.changeInterval - step%st.changeInterval
+                steps2 = st.reportInterval - step%st.reportInterval
                 steps = min(steps1, steps2)
-                isUpdateAttempt = (steps1 == steps)
                 return (steps, False, False, False, False)
 
             def report(self, simulation, state):
-                #calculate energies from each level:
-                energies = list()
-                for level in self.st.levels:
-                    self.st.scaling_function(simulation, level)
-                    pe = simulation.context.getState(getEnergy=True).getPotentialEnergy() #this is in kj/mole now
-                    energies.append(pe)
-                #set the tempered parameter back to what it used to be:
-                self.st.scaling_function(simulation, self.st.levels[self.st.currentLevel])
                 st = self.st
+                step = simulation.currentStep
+                isChangeStep = step%st.changeInterval == 0
+                isReportStep = step%st.reportInterval == 0
+                #calculate energies from each level, in kJ/mol without units:
+                kjmol = unit.kilojoule_per_mole
+                if st.forceGroup is None or st._linearScaling:
+                    #linearScaling gets the full energy from a single getState call below.
+                    static_pe = 0.0
+                    groups = -1
+                else:
+                    #only the tempered force group changes between levels, so the rest is calculated once:
+                    groups = st._forceGroupMask
+                    static_pe = simulation.context.getState(getEnergy=True, groups=st._staticGroupMask).getPotentialEnergy().value_in_unit(kjmol)
+                name = st._parameterName
+                if st._linearScaling:
+                    #the energy is linear in the parameter, so one evaluation plus the derivative gives every level:
+                    linearState = simulation.context.getState(getEnergy=True, getParameterDerivatives=True)
+                    current = st._ctx.getParameter(name)
+                    energies = linearState.getPotentialEnergy().value_in_unit(kjmol) + \
+                        (st._levelsArray - current)*linearState.getEnergyParameterDerivatives()[name]
+                    #in case currentLevel was changed without setting the parameter:
+                    if current != st.levels[st.currentLevel]:
+                        st._ctx.setParameter(name, st.levels[st.currentLevel])
+                else:
+                    #visit the levels starting after the current one, so the last level visited is
+                    #the current level and the tempered parameter doesn't need to be set back afterwards.
+                    N = len(st.levels)
+                    energies = np.empty(N, dtype=np.float64)
+                    for i in range(N):
+                        j = (st.currentLevel + 1 + i) % N
+                        if name is None:
+                            st.scaling_function(simulation, st.levels[j])
+                        else:
+                            st._ctx.setParameter(name, st.levels[j])
+                        energies[j] = simulation.context.getState(getEnergy=True, groups=groups).getPotentialEnergy().value_in_unit(kjmol)
+                    energies += static_pe
                 if st._weightUpdateFactor<st.cutoff:
                     st._updateWeights=False
-                if simulation.currentStep%st.changeInterval == 0:
+                if isChangeStep:
                     st._attemptLevelChange(energies)
-                if simulation.currentStep%st.reportInterval == 0:
-                    st._writeReport(energies[self.st.currentLevel])
+                if isReportStep:
+                    st._writeReport(energies[st.currentLevel])
 
         simulation.reporters.append(STReporter(self))
 
@@ -194,49 +306,42 @@ class GSST(object):
         headers = ['Steps', 'weightUpdate', 'Level', 'PotentialEnergy']
         for t in self.levels:
             headers.append('%g Weight' % t)
-        print('"%s"' % ('"\t"').join(headers), file=self._out)
-        #print('"'+('"\t"').join(headers)+'"', file=self._out)
+        self._write('"%s"\n' % ('"\t"').join(headers))
 
 
     def __del__(self):
+        self.close()
+
+    def flush(self):
+        """Write any buffered report lines to the report file."""
+        #a reportFile passed in only needs a write() method:
+        if hasattr(self._out, 'flush'):
+            self._out.flush()
+
+    def close(self):
+        """Flush the report file, and close it if GSST opened it."""
+        #_out isn't set if opening the report file failed in __init__:
+        if not hasattr(self, '_out') or getattr(self._out, 'closed', False):
+            return
         if self._openedFile:
             self._out.close()
+        else:
+            self.flush()
 
     @property
     def weights(self):
-        return [x-self._weights[0] for x in self._weights]
+        return (self._weights - self._weights[0]).tolist()
 
     def step(self, steps):
         """Advance the simulation by integrating a specified number of time steps."""
         self.simulation.step(steps)
 
-    def _attemptStateChange(self, probability):
-        #this is the metropolized independence sampling
-        r = random.random()
-        for j in range(len(probability)):
-            if r < probability[j]:
-                return j
-            r -= probability[j]
-        return self.currentTemperature
-
     def _attemptLevelChange(self, energies):
-        """Attempt to move to a different temperature."""
+        """Attempt to move to a different temperature.
 
-        #this turns the PE into a 'reduced potential', then calculates the normalized probability that the
-        #present configuration would have come from each of the levels. It then uses metropolized
-        #independence sampling to pick a level. 
-      
-        logProbability = [(self._weights[i]-self.inverseBaseTemperature*energies[i]) for i in range(len(self._weights))]
-        logProbability -= logsumexp(logProbability)
-        probability = np.exp(logProbability)
+        `energies` is an ndarray of the potential energy at each level, in kJ/mol."""
 
-        #peter eastmans no-numpy way:
-        #maxLogProb = max(logProbability)
-        #offset = maxLogProb + math.log(sum(math.exp(x-maxLogProb) for x in logProbability))
-        #probability = [math.exp(x-offset) for x in logProbability]
-
-
-        proposal = self._attemptStateChange(probability)
+        proposal, probability = _mc_step(self._weights, energies, self._beta, _rand())
         if proposal != self.currentLevel:
             self._hasMadeTransition = True
             self.currentLevel = proposal
@@ -245,22 +350,31 @@ class GSST(object):
         if self._updateWeights:
             self._weights[self.currentLevel] -= self._weightUpdateFactor
             self._histogram[self.currentLevel] += 1
-            minCounts = min(self._histogram)
-            if minCounts > 20 and minCounts >= 0.2*sum(self._histogram)/len(self._histogram):
+            self._histogramSum += 1
+            minCounts = self._histogram.min()
+            # Flat enough when minCounts >= 0.2*mean(histogram), written without the division.
+            if minCounts > 20 and 5*minCounts*len(self._histogram) >= self._histogramSum:
                 # Reduce the weight update factor and reset the histogram.
                 self._weightUpdateFactor *= 0.5
-                self._histogram = [0]*len(self.levels)
-                self._weights = [x-self._weights[0] for x in self._weights]
+                self._histogram.fill(0)
+                self._histogramSum = 0
+                self._weights -= self._weights[0]
             elif not self._hasMadeTransition and probability[self.currentLevel] > 0.99:
                 # Rapidly increase the weight update factor at the start of the simulation to find
                 # a reasonable starting value.
                 self._weightUpdateFactor *= 2.0
-                self._histogram = [0]*len(self.levels)
+                self._histogram.fill(0)
+                self._histogramSum = 0
         return
 
-    def _writeReport(self, nrg):
-        """Write out a line to the report."""
+    def _writeReport(self, potEnergy):
+        """Write out a line to the report. `potEnergy` is in kJ/mol."""
         
-        potEnergy = nrg.value_in_unit(unit.kilojoule/unit.mole)
-        values = [self._weightUpdateFactor]+[self.levels[self.currentLevel]]+[potEnergy]+self.weights
-        print(('%d\t' % self.simulation.currentStep) + '\t'.join('%g' % v for v in values), file=self._out)
+        values = [self._weightUpdateFactor, self.levels[self.currentLevel], potEnergy]+self.weights
+        self._write(('%d\t' % self.simulation.currentStep) + '\t'.join('%g' % v for v in values) + '\n')
+
+    def _write(self, line):
+        #files opened by GSST are binary, file objects passed in are assumed to be text.
+        if self._openedFile:
+            line = line.encode()
+        self._out.write(line)